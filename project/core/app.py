@@ -54,6 +54,35 @@ def on_create_all(callback):
     on_create_all_callbacks.append(callback)
 
 
+on_commit_callbacks = []
+
+
+def on_commit(callback):
+    on_commit_callbacks.append(callback)
+
+
+# Changes are collected per flush and only reported once they are committed
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_flush")
+def collect_changes(session, flush_context):
+    changes = session.info.setdefault("changes", {})
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        changes.setdefault(type(instance), set()).add(instance.id)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_commit")
+def report_changes(session):
+    changes = session.info.pop("changes", None)
+    if not changes:
+        return
+    for callback in on_commit_callbacks:
+        callback(changes)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_rollback")
+def discard_changes(session):
+    session.info.pop("changes", None)
+
+
 # TODO: Get rid of DuckDns, proxy should take care of that
 last_ip = None
 domain = config.get_config("DUCKDNS_DOMAIN")
@@ -75,9 +104,40 @@ def update_ip():
         )
 
 
+def add_missing_columns():  # db.create_all only creates tables which don't exist
+    inspector = sqlalchemy.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing_columns = [
+            column["name"] for column in inspector.get_columns(table.name)
+        ]
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            definition = sqlalchemy.schema.CreateColumn(column).compile(
+                dialect=db.engine.dialect
+            )
+            db.session.execute(
+                sqlalchemy.text(
+                    "ALTER TABLE %s ADD COLUMN %s" % (table.name, definition)
+                )
+            )
+    db.session.commit()
+
+
+def add_missing_indexes():  # Nor indexes of tables which already exist
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
 def run():
     with app.app_context():
         db.create_all()
+        add_missing_columns()
+        add_missing_indexes()
         for callback in on_create_all_callbacks:
             callback()
     scheduler.start()
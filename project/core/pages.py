@@ -4,11 +4,36 @@ import project.core.errors as errors
 import project.modules.users as users
 import project.modules.roles as roles
 import project.modules.articles as articles
+import project.modules.search as search
 import flask
 import werkzeug
 import mimetypes
 import re
 
+# Relevance is divided by the number of fields, so with half the fields of posts the
+# multipliers are halved, for titles and text to score like theirs
+search.StaticPageEngine(
+    "./project/website/static/",
+    [
+        {
+            "value": "title",
+            "method": search.basic_text,
+            "multiplier": 1.0,
+        },
+        {
+            "value": "text",
+            "method": search.basic_text,
+            "multiplier": 0.5,
+        },
+    ],
+    {
+        "type": "Page",
+        "name": lambda self: self.title,
+        "url": lambda self: self.url,
+    },
+    skipped=("css.html", "noscript.html"),
+)
+
 
 @app.app.route("/<path:path>/")
 def page(path):
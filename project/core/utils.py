@@ -1,4 +1,7 @@
 from datetime import datetime, timezone
+import collections
+import threading
+import time
 
 
 def now() -> datetime:
@@ -7,3 +10,61 @@ def now() -> datetime:
 
 def now_iso() -> str:
     return now().isoformat()
+
+
+class Cache:  # Values by key, optionally the least recently used and for a time
+    def __init__(self, size=None, ttl=None) -> None:
+        self.size, self.ttl = size, ttl
+        self.entries = collections.OrderedDict()  # key -> (expires, value)
+        self.generation = 0  # Number of times values were forgotten
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry or (entry[0] != None and entry[0] < time.monotonic()):
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    # Values computed before a forget may be out of date, so they are not stored.
+    # Callers read the generation before computing a value, and pass it here.
+    def set(self, key, value, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+
+            expires = self.ttl and time.monotonic() + self.ttl
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while self.size and len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def getOrBuild(self, key, build):  # Builds and stores the value if it is missing
+        value = self.get(key)
+        if value == None:
+            generation = self.generation
+            value = build()
+            self.set(key, value, generation)
+        return value
+
+    def forget(self, matches=None):  # The values whose keys match, or all of them
+        with self.lock:
+            self.generation += 1
+            for key in list(self.entries):
+                if matches == None or matches(key):
+                    del self.entries[key]
+
+    def getStats(self):
+        return {
+            "size": len(self.entries),
+            "max_size": self.size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -3,13 +3,25 @@ import project.core.utils as utils
 import project.modules.users as users
 import project.modules.roles as roles
 import project.modules.search as search
+import sqlalchemy
 import sqlalchemy.orm as orm
 import project.core.errors as errors
 import flask
+import urllib.parse as parse
 from datetime import datetime
 
+PAGE_SIZE = 25
+MAX_ABSTRACT = 250
+
 
 class Article(app.db.Model):
+    __table_args__ = (
+        sqlalchemy.Index(
+            "ix_article_published_date", "is_published", "creation_date", "id"
+        ),
+        sqlalchemy.Index("ix_article_date", "creation_date", "id"),
+    )
+
     id: orm.Mapped[int] = orm.mapped_column(primary_key=True)
     creation_date: orm.Mapped[str] = orm.mapped_column()
     creator_id: orm.Mapped[int] = orm.mapped_column()
@@ -18,6 +30,8 @@ class Article(app.db.Model):
     title: orm.Mapped[str] = orm.mapped_column(unique=True)
     abstract: orm.Mapped[str] = orm.mapped_column(nullable=True)
     body: orm.Mapped[str] = orm.mapped_column()
+    body_text: orm.Mapped[str] = orm.mapped_column(nullable=True)
+    body_abstract: orm.Mapped[str] = orm.mapped_column(nullable=True)
     # history: orm.Mapped[str] = orm.mapped_column(nullable=True) # TODO: History
 
     def getCreator(self):
@@ -28,6 +42,14 @@ class Article(app.db.Model):
             app.db.select(Article).where(Article.id == id)
         ).scalar_one_or_none()
 
+    # Unpublished articles are only seen by those who can edit them
+    def getVisibility(user):
+        if user and user.hasAPermission(
+            roles.Permission.EditArticles, roles.Permission.PreviewArticles
+        ):
+            return None
+        return Article.is_published == True
+
 
 search.SearchEngine(
     Article,
@@ -48,8 +70,8 @@ search.SearchEngine(
             "multiplier": 1.5,
         },
         {
-            "value": "body",
-            "method": search.formatted_text,
+            "value": "body_text",
+            "method": search.basic_text,
             "multiplier": 1.0,
         },
         {
@@ -64,9 +86,23 @@ search.SearchEngine(
         "url": lambda self: (self.path and "/" + self.path + "/")
         or ("/articles/" + str(self.id) + "/"),
     },
+    full_text=True,
+    visibility=Article.getVisibility,
 )
 
 
+@app.on_create_all
+def fill_body_text():
+    for article in app.db.session.execute(
+        app.db.select(Article).where(
+            (Article.body_text == None) | (Article.body_abstract == None)
+        )
+    ).scalars():
+        article.body_text = search.plain_text(article.body)
+        article.body_abstract = search.abstract_text(article.body, MAX_ABSTRACT)
+    app.db.session.commit()
+
+
 # API
 @app.app.route("/api/articles/", methods=["POST"])
 @app.app.route("/api/articles/<int:id>/", methods=["PUT", "DELETE"])
@@ -109,6 +145,8 @@ def api_create_article(id: int = None):
     article.is_published = "is_published" in data
     article.title = data["title"]
     article.body = data["body"]
+    article.body_text = search.plain_text(article.body)
+    article.body_abstract = search.abstract_text(article.body, MAX_ABSTRACT)
     article.path = path
 
     app.db.session.add(article)
@@ -146,48 +184,54 @@ def page_edit_article(id: int):
 @app.app.route("/articles/")
 def page_view_articles():
     user = users.User.getFromRequest()
+    before = flask.request.args.get("before")
+    try:
+        before_id = int(flask.request.args.get("before_id") or "0")
+    except ValueError:  # The cursor comes from the URL
+        raise errors.exceptions.BadRequest
+
+    # Pages start after the (creation date, id) of the last item of the page before,
+    # so that older pages cost the same as the first. Bodies are left in the database.
+    select = app.db.select(Article).options(
+        orm.defer(Article.body), orm.defer(Article.body_text)
+    )
+    select = select.order_by(Article.creation_date.desc(), Article.id.desc())
+    visibility = Article.getVisibility(user)
+    if visibility is not None:
+        select = select.where(visibility)
+    if before:
+        select = select.where(
+            sqlalchemy.tuple_(Article.creation_date, Article.id)
+            < sqlalchemy.tuple_(before, before_id)
+        )
+    articles = app.db.session.execute(select.limit(PAGE_SIZE + 1)).scalars().all()
 
-    articles = (
-        app.db.session.execute(
-            app.db.select(Article).order_by(Article.creation_date.desc())
+    next_url = None
+    if len(articles) > PAGE_SIZE:
+        articles = articles[:PAGE_SIZE]
+        next_url = "/articles/?" + parse.urlencode(
+            {"before": articles[-1].creation_date, "before_id": articles[-1].id}
         )
-        .scalars()
-        .fetchmany(25)
-    )
-    user = users.User.getFromRequest()
 
+    creators = users.User.getFromIds(article.creator_id for article in articles)
     items = []
     for article in articles:
-        if not article.is_published:
-            if not user:
-                continue
-            if not (
-                user.hasAPermission(
-                    roles.Permission.EditArticles, roles.Permission.PreviewArticles
-                )
-            ):
-                continue
-
         items.append(
             {
                 "id": article.id,
                 "creation_date": article.creation_date,
-                "creator": users.User.getFromId(article.creator_id).getNameText(),
+                "creator": creators[article.creator_id].getNameText(),
                 "title": article.title,
-                "abstract": article.abstract,
-                "body": article.body,
+                "abstract": article.abstract or article.body_abstract,
             }
         )
 
-        if len(items) >= 25:
-            break
-
     return flask.render_template(
         "/articles/index.html",
         title="Articles",
         base_url="/articles/",
-        max_abstract=250,
         items=items,
+        next_url=next_url,
         allow_new=user and user.hasPermission(roles.Permission.EditArticles),
     )
 
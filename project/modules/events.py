@@ -118,6 +118,7 @@ search.SearchEngine(
         "name": lambda self: self.title,
         "url": lambda self: "/events/" + str(self.id) + "/",
     },
+    full_text=True,
 )
 
 
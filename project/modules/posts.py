@@ -4,13 +4,24 @@ import project.core.utils as utils
 import project.modules.users as users
 import project.modules.roles as roles
 import project.modules.search as search
+import sqlalchemy
 import sqlalchemy.orm as orm
 import flask
 import urllib.parse as parse
 import json
 
+PAGE_SIZE = 25
+MAX_ABSTRACT = 250
+
 
 class Post(app.db.Model):
+    __table_args__ = (
+        sqlalchemy.Index(
+            "ix_post_published_date", "is_published", "creation_date", "id"
+        ),
+        sqlalchemy.Index("ix_post_date", "creation_date", "id"),
+    )
+
     id: orm.Mapped[int] = orm.mapped_column(primary_key=True)
     creation_date: orm.Mapped[str] = orm.mapped_column()
     creator_id: orm.Mapped[int] = orm.mapped_column()
@@ -19,6 +30,8 @@ class Post(app.db.Model):
     title: orm.Mapped[str] = orm.mapped_column(unique=True)
     abstract: orm.Mapped[str] = orm.mapped_column(nullable=True)
     body: orm.Mapped[str] = orm.mapped_column()
+    body_text: orm.Mapped[str] = orm.mapped_column(nullable=True)
+    body_abstract: orm.Mapped[str] = orm.mapped_column(nullable=True)
     # history: orm.Mapped[str] = orm.mapped_column(nullable=True) # TODO: History
 
     def getCreator(self):
@@ -29,6 +42,14 @@ class Post(app.db.Model):
             app.db.select(Post).where(Post.id == id)
         ).scalar_one_or_none()
 
+    # Unpublished posts are only seen by those who can edit them
+    def getVisibility(user):
+        if user and user.hasAPermission(
+            roles.Permission.EditPosts, roles.Permission.PreviewPosts
+        ):
+            return None
+        return Post.is_published == True
+
 
 search.SearchEngine(
     Post,
@@ -44,8 +65,8 @@ search.SearchEngine(
             "multiplier": 1.5,
         },
         {
-            "value": "body",
-            "method": search.formatted_text,
+            "value": "body_text",
+            "method": search.basic_text,
             "multiplier": 1.0,
         },
         {
@@ -59,9 +80,23 @@ search.SearchEngine(
         "name": lambda self: self.title,
         "url": lambda self: "/posts/" + str(self.id) + "/",
     },
+    full_text=True,
+    visibility=Post.getVisibility,
 )
 
 
+@app.on_create_all
+def fill_body_text():
+    for post in app.db.session.execute(
+        app.db.select(Post).where(
+            (Post.body_text == None) | (Post.body_abstract == None)
+        )
+    ).scalars():
+        post.body_text = search.plain_text(post.body)
+        post.body_abstract = search.abstract_text(post.body, MAX_ABSTRACT)
+    app.db.session.commit()
+
+
 # API
 @app.app.route("/api/posts/", methods=["POST"])
 @app.app.route("/api/posts/<int:id>/", methods=["PUT", "DELETE"])
@@ -97,6 +132,8 @@ def api_create_post(id=None):
     post.is_published = "is_published" in data
     post.title = data["title"]
     post.body = data["body"]
+    post.body_text = search.plain_text(post.body)
+    post.body_abstract = search.abstract_text(post.body, MAX_ABSTRACT)
 
     app.db.session.add(post)
     app.db.session.commit()
@@ -119,11 +156,19 @@ def feed_rss():
         )
     )
 
+    posts = (
+        app.db.session.execute(
+            app.db.select(Post).options(orm.defer(Post.body), orm.defer(Post.body_text))
+        )
+        .scalars()
+        .all()
+    )
+
     return flask.render_template(
         "feeds/feed.rss",
         base_url=base_url,
-        posts=app.db.session.execute(app.db.select(Post)).scalars(),
-        max_abstract=250,
+        posts=posts,
+        creators=users.User.getFromIds(post.creator_id for post in posts),
         year=utils.now().year,
     )
 
@@ -154,45 +199,55 @@ def page_edit_post(id: int):
 
 @app.app.route("/posts/")
 def page_view_posts():
-    posts = (
-        app.db.session.execute(app.db.select(Post).order_by(Post.creation_date.desc()))
-        .scalars()
-        .fetchmany(25)
-    )
     user = users.User.getFromRequest()
+    before = flask.request.args.get("before")
+    try:
+        before_id = int(flask.request.args.get("before_id") or "0")
+    except ValueError:  # The cursor comes from the URL
+        raise errors.exceptions.BadRequest
+
+    # Pages start after the (creation date, id) of the last item of the page before,
+    # so that older pages cost the same as the first. Bodies are left in the database.
+    select = app.db.select(Post).options(
+        orm.defer(Post.body), orm.defer(Post.body_text)
+    )
+    select = select.order_by(Post.creation_date.desc(), Post.id.desc())
+    visibility = Post.getVisibility(user)
+    if visibility is not None:
+        select = select.where(visibility)
+    if before:
+        select = select.where(
+            sqlalchemy.tuple_(Post.creation_date, Post.id)
+            < sqlalchemy.tuple_(before, before_id)
+        )
+    posts = app.db.session.execute(select.limit(PAGE_SIZE + 1)).scalars().all()
+
+    next_url = None
+    if len(posts) > PAGE_SIZE:
+        posts = posts[:PAGE_SIZE]
+        next_url = "/posts/?" + parse.urlencode(
+            {"before": posts[-1].creation_date, "before_id": posts[-1].id}
+        )
 
+    creators = users.User.getFromIds(post.creator_id for post in posts)
     items = []
     for post in posts:
-        if not post.is_published:
-            if not user:
-                continue
-            if not (
-                user.hasAPermission(
-                    roles.Permission.EditPosts, roles.Permission.PreviewPosts
-                )
-            ):
-                continue
-
         items.append(
             {
                 "id": post.id,
                 "creation_date": post.creation_date,
-                "creator": users.User.getFromId(post.creator_id).getNameText(),
+                "creator": creators[post.creator_id].getNameText(),
                 "title": post.title,
-                "abstract": post.abstract,
-                "body": post.body,
+                "abstract": post.abstract or post.body_abstract,
             }
         )
 
-        if len(items) >= 25:
-            break
-
     return flask.render_template(
         "/posts/index.html",
         title="Posts",
         base_url="/posts/",
-        max_abstract=250,
         items=items,
+        next_url=next_url,
         allow_new=user and user.hasPermission(roles.Permission.EditPosts),
     )
 
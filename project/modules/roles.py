@@ -5,6 +5,7 @@ import project.core.config as config
 import project.modules.users as users
 import project.modules.search as search
 import flask
+import sqlalchemy
 import sqlalchemy.orm as orm
 import enum
 import json
@@ -25,6 +26,13 @@ Permission = enum.Enum(
 )
 
 
+def get_permission_mask(*permissions) -> int:  # One bit per permission
+    mask = 0
+    for permission in permissions:
+        mask |= 1 << permission.value
+    return mask
+
+
 class Role(app.db.Model):
     id: orm.Mapped[int] = orm.mapped_column(primary_key=True)
     parent_id: orm.Mapped[int] = orm.mapped_column(nullable=True)
@@ -42,11 +50,16 @@ class Role(app.db.Model):
         return Role.getFromId(1)
 
     def getUsers(self):
-        all_users = []
-        for user in app.db.session.execute(app.db.select(users.User)).scalars():
-            if self in user.getRoles():
-                all_users.append(user)
-        return all_users
+        return (
+            app.db.session.execute(
+                app.db.select(users.User)
+                .join(users.UserRole, users.UserRole.user_id == users.User.id)
+                .where(users.UserRole.role_id == self.id)
+                .order_by(users.User.id)
+            )
+            .scalars()
+            .all()
+        )
 
     def getParentRole(self):
         if self.parent_id == None:
@@ -76,12 +89,29 @@ class Role(app.db.Model):
             .all()
         )
 
-    def getDescendantRoles(self):
-        descendants = []
-        for child in self.getChildRoles():
-            descendants.append(child)
-            descendants.extend(child.getDescendantRoles())
-        return descendants
+    def getDescendantRoles(self):  # Nearest first
+        if not self.id:
+            return []
+
+        return (
+            app.db.session.execute(
+                app.db.select(Role)
+                .join(RoleAncestor, RoleAncestor.descendant_id == Role.id)
+                .where(RoleAncestor.ancestor_id == self.id, RoleAncestor.depth > 0)
+                .order_by(RoleAncestor.depth, Role.id)
+            )
+            .scalars()
+            .all()
+        )
+
+    # {"role", "children"} nodes of the role and its descendants, from one query
+    def getTree(self):
+        nodes = {self.id: {"role": self, "children": []}}
+        for role in self.getDescendantRoles():  # Parents come before their children
+            nodes[role.id] = {"role": role, "children": []}
+            if role.parent_id in nodes:
+                nodes[role.parent_id]["children"].append(nodes[role.id])
+        return nodes[self.id]
 
     def getPermissions(self):
         permissions = []
@@ -110,18 +140,73 @@ class Role(app.db.Model):
             raw_permissions.append(permission.name)
         self.permissions = json.dumps(raw_permissions)
 
+    def getPermissionMask(self) -> int:
+        return get_permission_mask(*self.getPermissions())
+
     def hasPermission(self, permission: Permission):
         if self.id == 1:
             return True
         return permission in self.getPermissions()
 
     def overseesRole(self, role) -> bool:
-        parent_role = role
-        while parent_role:
-            parent_role = parent_role.getParentRole()
-            if parent_role == self:
-                return True
-        return False
+        if not role or not role.id:
+            return False
+
+        return (
+            app.db.session.execute(
+                app.db.select(RoleAncestor.id).where(
+                    RoleAncestor.ancestor_id == self.id,
+                    RoleAncestor.descendant_id == role.id,
+                    RoleAncestor.depth > 0,
+                )
+            ).first()
+            != None
+        )
+
+
+class RoleAncestor(app.db.Model):  # Each role paired with itself and its ancestors
+    __table_args__ = (sqlalchemy.Index(None, "ancestor_id", "descendant_id"),)
+
+    id: orm.Mapped[int] = orm.mapped_column(primary_key=True)
+    ancestor_id: orm.Mapped[int] = orm.mapped_column()
+    descendant_id: orm.Mapped[int] = orm.mapped_column(index=True)
+    depth: orm.Mapped[int] = orm.mapped_column()  # 0 for the role itself
+
+
+def get_role_ancestors(parents):  # RoleAncestor rows, from role id -> parent id
+    rows = []
+    for role_id in parents:
+        ancestor_id, depth, seen = role_id, 0, set()
+        while ancestor_id in parents and not ancestor_id in seen:
+            rows.append(
+                {"ancestor_id": ancestor_id, "descendant_id": role_id, "depth": depth}
+            )
+            seen.add(ancestor_id)
+            ancestor_id, depth = parents[ancestor_id], depth + 1
+    return rows
+
+
+def rebuild_role_ancestors(connection):  # Roles are few, so all of them are redone
+    parents = dict(connection.execute(sqlalchemy.select(Role.id, Role.parent_id)).all())
+    connection.execute(sqlalchemy.delete(RoleAncestor))
+    rows = get_role_ancestors(parents)
+    if rows:
+        connection.execute(sqlalchemy.insert(RoleAncestor), rows)
+
+
+# The hierarchy is written in the same transaction as the roles it comes from
+@sqlalchemy.event.listens_for(orm.Session, "after_flush")
+def sync_role_ancestors(session, flush_context):
+    is_changed = False
+    for instance in list(session.new) + list(session.deleted):
+        is_changed = is_changed or isinstance(instance, Role)
+    for instance in session.dirty:
+        if isinstance(instance, Role):
+            history = sqlalchemy.inspect(instance).attrs.parent_id.history
+            is_changed = is_changed or history.has_changes()
+
+    if is_changed:
+        rebuild_role_ancestors(session.connection())
 
 
 search.SearchEngine(
@@ -172,6 +257,12 @@ def create_admin():
         app.db.session.commit()
 
 
+@app.on_create_all
+def build_role_ancestors():
+    rebuild_role_ancestors(app.db.session.connection())
+    app.db.session.commit()
+
+
 # API
 @app.app.route("/api/roles/", methods=["POST"])
 @app.app.route("/api/roles/<int:id>/", methods=["PUT", "DELETE"])
@@ -199,14 +290,17 @@ def api_create_role(id=None):
         parent = role.getParentRole()
     if not parent:
         raise errors.InstanceNotFound
-    print(user.roles)
     if not user.overseesRole(parent) and not user.hasRole(parent):
         raise errors.exceptions.Forbidden
 
     if flask.request.method == "DELETE":
-        for deleted_role in role.getDescendantRoles() + [role]:
-            for user in deleted_role.getUsers():
-                user.removeRole(role)
+        deleted_roles = role.getDescendantRoles() + [role]
+        app.db.session.execute(
+            app.db.delete(users.UserRole).where(
+                users.UserRole.role_id.in_([deleted.id for deleted in deleted_roles])
+            )
+        )
+        for deleted_role in deleted_roles:
             app.db.session.delete(deleted_role)
         app.db.session.commit()
         return flask.redirect("/roles/")
@@ -298,7 +392,7 @@ def page_view_roles():
         "roles/index.html",
         user=users.User.getFromRequest(),
         Permission=Permission,
-        root_role=Role.getRootRole(),
+        role_tree=Role.getRootRole().getTree(),
     )
 
 
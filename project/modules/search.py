@@ -1,26 +1,159 @@
 import project.core.app as app
 import project.core.errors as errors
+import project.core.config as config
+import project.core.utils as utils
+import project.modules.users as users
 import flask
-from difflib import SequenceMatcher
+import sqlalchemy
+import sqlalchemy.orm as orm
 import json
+import base64
+import re
+import bisect
+import heapq
+import time
+import collections
+import concurrent.futures
+import threading
+import os
+import html.parser
+from datetime import datetime, timedelta, timezone
 from unidecode import unidecode
 
 MAX_REQUEST_LENGTH = 50
+MAX_PREFIX_EXPANSIONS = 50
+MAX_LOAD_CHUNK = 500
+MAX_SCAN_CHUNK = 100  # Rows fetched at a time when scanning
+MAX_SUGGESTIONS = 20
+MIN_RELEVANCE = 0.1  # Results below it aren't shown, nor counted as answers
+BACKEND = config.get_config("SEARCH_BACKEND") or "index"  # "index", "fts5" or "scan"
+CACHE_SIZE = config.get_config("SEARCH_CACHE_SIZE") or 256
+CACHE_TTL = config.get_config("SEARCH_CACHE_TTL") or 60  # Seconds
+WORKERS = config.get_config("SEARCH_WORKERS") or 4
+TIME_BUDGET = config.get_config("SEARCH_TIME_BUDGET") or 2  # Seconds per search
+WORK_BUDGET = config.get_config("SEARCH_WORK_BUDGET") or 1000000  # Matches per search
+RECORD_BUFFER = config.get_config("SEARCH_RECORD_BUFFER") or 1000
+RECORD_INTERVAL = config.get_config("SEARCH_RECORD_INTERVAL") or 60  # Seconds
 
 
-# TODO: Make a way better search system
-# Using sql "LIKE"? https://stackoverflow.com/questions/3325467/sqlalchemy-equivalent-to-sql-like-statement
-def basic_text(text, query):
+def tokenize(text):
+    return re.findall("[a-z0-9]+", unidecode((text or "").lower()))
+
+
+def normalize(query):
+    return " ".join(unidecode((query or "").lower()).split())
+
+
+MONTH = "(jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?|sept?(?:ember)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)\\.?"
+DAY = "(\\d{1,2})(?:st|nd|rd|th)?"
+MONTHS = ("jan", "feb", "mar", "apr", "may", "jun")
+MONTHS += ("jul", "aug", "sep", "oct", "nov", "dec")
+
+# Patterns of dates, months and years, the (year, month, day) groups in them, and
+# whether they stay in the text. Bare years do, as they may be team numbers.
+DATE_PATTERNS = [
+    ("\\b(\\d{4})[-/](\\d{1,2})[-/](\\d{1,2})\\b", (1, 2, 3), False),
+    ("\\b(\\d{4})[-/](\\d{1,2})\\b", (1, 2, None), False),
+    ("\\b%s %s,? (\\d{4})\\b" % (MONTH, DAY), (3, 1, 2), False),
+    ("\\b%s %s,? (\\d{4})\\b" % (DAY, MONTH), (3, 2, 1), False),
+    ("\\b%s,? (\\d{4})\\b" % MONTH, (2, 1, None), False),
+    ("\\b(\\d{4})\\b", (1, None, None), True),
+]
+
+
+def get_date_range(year, month=None, day=None):  # Start and end timestamps
+    if day:
+        start = datetime(year, month, day, tzinfo=timezone.utc)
+        end = start + timedelta(days=1)
+    elif month:
+        start = datetime(year, month, 1, tzinfo=timezone.utc)
+        end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+    else:
+        start = datetime(year, 1, 1, tzinfo=timezone.utc)
+        end = datetime(year + 1, 1, 1, tzinfo=timezone.utc)
+    return start.timestamp(), end.timestamp()
+
+
+# The query without its dates, their timestamp ranges, and the year each range
+# left in the text, if any
+def parse_dates(query):
+    text = normalize(query)
+    ranges, years = [], []
+
+    def replace_date(match, groups, is_kept):
+        year, month, day = [group and match.group(group) for group in groups]
+        if month and not month.isdigit():
+            month = MONTHS.index(month[:3]) + 1
+        try:
+            ranges.append(
+                get_date_range(int(year), month and int(month), day and int(day))
+            )
+        except (ValueError, OverflowError):
+            return match.group(0)
+        years.append(is_kept and match.group(0) or None)
+        return is_kept and match.group(0) or " "
+
+    for pattern, groups, is_kept in DATE_PATTERNS:
+        text = re.sub(pattern, lambda match: replace_date(match, groups, is_kept), text)
+    return text, ranges, years
+
+
+def parse_timestamp(text):
+    try:
+        date = datetime.fromisoformat(text)
+    except (ValueError, TypeError):
+        return None
+    if not date.tzinfo:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
+
+
+# Edit distance of the query to the best match ending at each character of the text,
+# in one pass (Myers, 1999). Matches start anywhere unless the whole text must match.
+def match_distances(text, query, whole_text=False):
+    # Bit i of a character's mask is set where the query has that character
+    masks = {}
+    for position, character in enumerate(query):
+        masks[character] = masks.get(character, 0) | (1 << position)
+
+    # Vertical deltas of the edit distance matrix, one bit per query character
+    all_bits, last_bit = (1 << len(query)) - 1, 1 << (len(query) - 1)
+    positive, negative = all_bits, 0
+    distance = len(query)
+    carry = whole_text and 1 or 0  # Skipping the start of the text costs an edit
+
+    for character in text:
+        equal = masks.get(character, 0)
+        vertical = equal | negative
+        horizontal = (((equal & positive) + positive) ^ positive) | equal
+        horizontal_positive = negative | ~(horizontal | positive)
+        horizontal_negative = positive & horizontal
+
+        if horizontal_positive & last_bit:
+            distance += 1
+        elif horizontal_negative & last_bit:
+            distance -= 1
+
+        horizontal_positive = ((horizontal_positive << 1) | carry) & all_bits
+        horizontal_negative = (horizontal_negative << 1) & all_bits
+        positive = (horizontal_negative | ~(vertical | horizontal_positive)) & all_bits
+        negative = horizontal_positive & vertical
+
+        yield distance
+
+
+def basic_text(text, query):  # Approximate substring matching
     text = unidecode(text.lower())
     query = unidecode(query.lower())
+    if not query:
+        return 0
 
     ratio_sum = 0
     ratio_count = 0
 
-    for position in range(0, len(text)):
-        current_text = text[position : position + len(query)]
-
-        base_value = SequenceMatcher(None, current_text, query).ratio()
+    for distance in match_distances(text, query):
+        # Edit distance of the best match ending here, as a similarity ratio
+        base_value = 1 - distance / len(query)
         exponential_value = 5 ** (base_value - 0.5) - 1
         exponential_value = max(min(exponential_value, 1), 0)
 
@@ -31,56 +164,789 @@ def basic_text(text, query):
     return ratio_sum / (ratio_count or 1)
 
 
-def formatted_text(text, query):  # Quill.js/parchment format
-    new_text = ""
+def edit_distance(text, query):  # Levenshtein distance
+    if not query:
+        return len(text)
 
-    for item in json.loads(text)[
-        "ops"
-    ]:  # See https://quilljs.com/docs/delta/ for JSON structure
-        if not "insert" in item:
+    distance = len(query)
+    for distance in match_distances(text, query, whole_text=True):
+        pass
+    return distance
+
+
+def quill_text(text):  # Quill.js/parchment format
+    # Older bodies weren't checked, so text which isn't JSON is read as it is, and
+    # JSON which isn't a delta has no text
+    try:
+        ops = json.loads(text)["ops"]
+    except ValueError:
+        return text
+    except (TypeError, KeyError, IndexError):
+        return ""
+    if type(ops) != list:
+        return ""
+
+    new_text = ""
+    for item in ops:  # See https://quilljs.com/docs/delta/ for JSON structure
+        if type(item) != dict or not "insert" in item:
             continue
         if type(item["insert"]) != str:
             continue
         new_text += item["insert"]
 
-    return basic_text(new_text, query)
+    return new_text
+
+
+def plain_text(text):  # Searchable text of a Quill.js body, stored when it is written
+    return unidecode(quill_text(text).lower())
+
+
+def abstract_text(text, length):  # Readable start of a Quill.js body for list pages
+    words = " ".join(quill_text(text).split())
+    if len(words) > length:
+        return words[:length].rstrip() + "..."
+    return words
 
 
-def time_iso(text, query):  # TODO: Improve ISO support
-    return basic_text(text, query)
+def time_iso(text, query):  # Share of the dates in the query which contain the time
+    _, ranges, _ = parse_dates(query)
+    timestamp = parse_timestamp(text)
+    if not ranges or timestamp == None:
+        return 0
+
+    matches = 0
+    for start, end in ranges:
+        if start <= timestamp < end:
+            matches += 1
+    return matches / len(ranges)
+
+
+def top(count, scored):  # Highest scoring (score, value) pairs, best first
+    key = lambda pair: pair[0]
+    if count is None:
+        return sorted(scored, key=key, reverse=True)
+    return heapq.nlargest(count, scored, key=key)
+
+
+class SearchIndex:  # Inverted index from tokens to the fields of rows which contain them
+    is_public = False  # Whether only the rows and fields anyone can see are indexed
+
+    def __init__(self, engine) -> None:
+        self.engine = engine
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        self.postings = {}  # token -> {row id -> set of field positions}
+        self.documents = {}  # row id -> set of tokens
+        self.vocabulary = []  # Sorted tokens, for prefix lookups
+
+    def build(self, rows):  # From (row, whether anyone can see it) pairs
+        with self.lock:
+            self.clear()
+            self.update((), rows)
+
+    def update(self, ids, rows):  # Reindexes the rows with the ids, from their new rows
+        with self.lock:
+            for row_id in ids:
+                self.remove(row_id)
+            for row, is_public in rows:
+                if is_public or not self.is_public:
+                    self.add(row)
+
+    def getFieldTokens(self, row):  # (field position, token) of each text field
+        for position, field in enumerate(self.engine.fields):
+            if field["method"] == time_iso:
+                continue  # Dates are in the DateIndex
+            if self.is_public and "visible" in field and not field["visible"](None):
+                continue
+
+            text = self.engine.getValue(row, field)
+            for token in tokenize(text):
+                yield position, token
+
+    def add(self, row):
+        tokens = set()
+        for position, token in self.getFieldTokens(row):
+            tokens.add(token)
+            if not token in self.postings:
+                self.postings[token] = {}
+                bisect.insort(self.vocabulary, token)
+            self.postings[token].setdefault(row.id, set()).add(position)
+
+        self.documents[row.id] = tokens
+
+    def remove(self, row_id):
+        for token in self.documents.pop(row_id, ()):
+            posting = self.postings[token]
+            posting.pop(row_id, None)
+            if not posting:
+                del self.postings[token]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, token)]
+
+    # Indexed tokens starting with a query token, and their weight
+    def expand(self, token):
+        expansions = []
+        start = bisect.bisect_left(self.vocabulary, token)
+        for term in self.vocabulary[start : start + MAX_PREFIX_EXPANSIONS]:
+            if not term.startswith(token):
+                break
+            expansions.append((term, len(token) / len(term)))
+        return expansions
+
+    # (row id, field position, query part) -> how well the field matches a token
+    def getWeights(self, tokens, budget=None):
+        weights = {}
+        with self.lock:
+            for token_position, token in enumerate(tokens):
+                for term, weight in self.expand(token):
+                    if budget and not budget.spend(len(self.postings[term])):
+                        return weights
+                    for row_id, positions in self.postings[term].items():
+                        for position in positions:
+                            key = (row_id, position, token_position)
+                            if weight > weights.get(key, 0):
+                                weights[key] = weight
+        return weights
+
+
+class DateIndex(SearchIndex):  # Sorted timestamps of the date fields of rows
+    def clear(self):
+        self.entries = []  # Sorted (timestamp, row id, field position)
+        self.documents = {}  # row id -> entries
+
+    def add(self, row):
+        entries = []
+        for position, field in enumerate(self.engine.fields):
+            if field["method"] != time_iso:
+                continue
+
+            timestamp = parse_timestamp(self.engine.getValue(row, field))
+            if timestamp != None:
+                entries.append((timestamp, row.id, position))
+
+        for entry in entries:
+            bisect.insort(self.entries, entry)
+        self.documents[row.id] = entries
+
+    def remove(self, row_id):
+        for entry in self.documents.pop(row_id, ()):
+            del self.entries[bisect.bisect_left(self.entries, entry)]
+
+    # Like SearchIndex.getWeights, for the date ranges of a query and their parts
+    def getWeights(self, ranges, parts):
+        weights = {}
+        with self.lock:
+            for (start, end), part in zip(ranges, parts):
+                first = bisect.bisect_left(self.entries, (start,))
+                last = bisect.bisect_left(self.entries, (end,))
+                for _, row_id, position in self.entries[first:last]:
+                    weights[(row_id, position, part)] = 1
+        return weights
+
+
+class SuggestionIndex(SearchIndex):  # Sorted names of rows, for autocompletion
+    def clear(self):
+        self.keys = []  # Sorted (key, row id), a key for each word a name starts at
+        self.documents = {}  # row id -> (name, url, keys)
+
+    def add(self, row):
+        name = self.engine.usage["name"](row)
+        words = tokenize(name)
+        keys = [" ".join(words[position:]) for position in range(len(words))]
+
+        for key in keys:
+            bisect.insort(self.keys, (key, row.id))
+        self.documents[row.id] = (name, self.engine.usage["url"](row), keys)
+
+    def remove(self, row_id):
+        _, _, keys = self.documents.pop(row_id, (None, None, ()))
+        for key in keys:
+            del self.keys[bisect.bisect_left(self.keys, (key, row_id))]
+
+    # Row id -> (whether only a later word matches, name, url)
+    def complete(self, prefix):
+        matches = {}
+        with self.lock:
+            start = bisect.bisect_left(self.keys, (prefix,))
+            for key, row_id in self.keys[start : start + MAX_PREFIX_EXPANSIONS]:
+                if not key.startswith(prefix):
+                    break
+
+                name, url, keys = self.documents[row_id]
+                is_later_word = key != keys[0]
+                if row_id in matches and matches[row_id][0] <= is_later_word:
+                    continue
+                matches[row_id] = (is_later_word, name, url)
+        return matches
+
+
+class BKTree:  # Terms arranged by edit distance, for finding close spellings
+    def __init__(self) -> None:
+        self.root = None  # (term, {distance -> child node})
+
+    def add(self, term):
+        if not self.root:
+            self.root = (term, {})
+            return
+
+        node = self.root
+        while True:
+            distance = edit_distance(term, node[0])
+            if distance == 0:
+                return
+            if not distance in node[1]:
+                node[1][distance] = (term, {})
+                return
+            node = node[1][distance]
+
+    def find(self, term, max_distance):  # (distance, term) within a distance
+        matches = []
+        nodes = self.root and [self.root] or []
+        while nodes:
+            node = nodes.pop()
+            distance = edit_distance(term, node[0])
+            if distance <= max_distance:
+                matches.append((distance, node[0]))
+
+            # Children further than this could not be within the distance
+            for child_distance, child in node[1].items():
+                if abs(child_distance - distance) <= max_distance:
+                    nodes.append(child)
+        return matches
+
+
+class SpellingIndex(SearchIndex):  # Vocabulary of an engine, for spelling suggestions
+    is_public = True  # Suggestions must not reveal words from hidden rows
+
+    def clear(self):
+        self.counts = {}  # token -> number of rows with it, terms at 0 are removed
+        self.documents = {}  # row id -> set of tokens
+        self.tree = BKTree()
+
+    def add(self, row):
+        tokens = set()
+        for _, token in self.getFieldTokens(row):
+            if token.isdigit():
+                continue
+            tokens.add(token)
+
+        for token in tokens:
+            if not token in self.counts:
+                self.tree.add(token)
+            self.counts[token] = self.counts.get(token, 0) + 1
+        self.documents[row.id] = tokens
+
+    def remove(self, row_id):
+        for token in self.documents.pop(row_id, ()):
+            self.counts[token] -= 1
+
+    def update(self, ids, rows):
+        super().update(ids, rows)
+
+        # Removed terms stay in the tree until they are most of it
+        with self.lock:
+            removed_count = list(self.counts.values()).count(0)
+            if removed_count > len(self.counts) / 2:
+                self.counts = {t: c for t, c in self.counts.items() if c}
+                self.tree = BKTree()
+                for token in self.counts:
+                    self.tree.add(token)
+
+    def isKnown(self, token):
+        return self.counts.get(token, 0) > 0
+
+    def find(self, token, max_distance):  # (distance, -row count, term)
+        with self.lock:
+            return [
+                (distance, -self.counts[term], term)
+                for distance, term in self.tree.find(token, max_distance)
+                if self.counts[term]
+            ]
+
+
+cache = utils.Cache(CACHE_SIZE, CACHE_TTL)  # Rankings, by engine and query
+
+
+# Time and work which a search can use, shared by the engines ranking it. Engines
+# check it as they go, and stop with the best results so far once it runs out.
+class SearchBudget:
+    def __init__(self, seconds=TIME_BUDGET, work=WORK_BUDGET) -> None:
+        self.deadline = time.monotonic() + seconds
+        self.work = work  # Fields or postings which can still be scored
+        self.exceeded = None  # "time" or "work" once it runs out
+        self.lock = threading.Lock()
+
+    def spend(self, work=1):  # Whether the search can go on
+        with self.lock:
+            self.work -= work
+            if not self.exceeded and self.work < 0:
+                self.exceeded = "work"
+            elif not self.exceeded and time.monotonic() > self.deadline:
+                self.exceeded = "time"
+            return not self.exceeded
+
+
+class SearchBudgetStats:  # How often searches ran out of their budget, and on what
+    def __init__(self) -> None:
+        self.searches, self.exceeded = 0, {"time": 0, "work": 0}
+        self.recent = collections.deque(maxlen=20)  # Queries which ran out last
+        self.lock = threading.Lock()
+
+    def record(self, query, budget):
+        with self.lock:
+            self.searches += 1
+            if budget.exceeded:
+                self.exceeded[budget.exceeded] += 1
+                self.recent.append({"query": query, "exceeded": budget.exceeded})
+
+    def getStats(self):
+        with self.lock:
+            return {
+                "searches": self.searches,
+                "exceeded": dict(self.exceeded),
+                "recent": list(self.recent),
+            }
+
+
+budget_stats = SearchBudgetStats()
+pool = concurrent.futures.ThreadPoolExecutor(WORKERS, "search")
+
+
+class SearchRecord(app.db.Model):  # A search which was made, for analytics
+    id: orm.Mapped[int] = orm.mapped_column(primary_key=True)
+    creation_date: orm.Mapped[str] = orm.mapped_column(index=True)
+    query: orm.Mapped[str] = orm.mapped_column()
+    latency: orm.Mapped[float] = orm.mapped_column()  # Seconds
+    result_count: orm.Mapped[int] = orm.mapped_column()
+    redirected: orm.Mapped[bool] = orm.mapped_column(default=False)
+    partial: orm.Mapped[bool] = orm.mapped_column(default=False)
+
+    # The latency at a share of the records since a date, from 0 to 1
+    def getPercentile(since, share):
+        count = app.db.session.execute(
+            app.db.select(sqlalchemy.func.count(SearchRecord.id)).where(
+                SearchRecord.creation_date >= since
+            )
+        ).scalar_one()
+        if not count:
+            return None
+
+        return app.db.session.execute(
+            app.db.select(SearchRecord.latency)
+            .where(SearchRecord.creation_date >= since)
+            .order_by(SearchRecord.latency)
+            .offset(min(count - 1, int(count * share)))
+            .limit(1)
+        ).scalar_one()
+
+    def getSlowest(since, count):
+        return (
+            app.db.session.execute(
+                app.db.select(SearchRecord)
+                .where(SearchRecord.creation_date >= since)
+                .order_by(SearchRecord.latency.desc())
+                .limit(count)
+            )
+            .scalars()
+            .all()
+        )
+
+    def getUnanswered(since, count):  # (query, times) of searches without results
+        return app.db.session.execute(
+            app.db.select(SearchRecord.query, sqlalchemy.func.count(SearchRecord.id))
+            .where(SearchRecord.creation_date >= since, SearchRecord.result_count == 0)
+            .group_by(SearchRecord.query)
+            .order_by(sqlalchemy.func.count(SearchRecord.id).desc())
+            .limit(count)
+        ).all()
+
+
+# Searches are kept in memory and written in batches, so that searching doesn't
+# write to the database. When the buffer is full, the oldest are dropped.
+records = collections.deque(maxlen=RECORD_BUFFER)
+
+
+def record_search(query, latency, results, redirected=False, partial=False):
+    result_count = 0
+    for result in results:
+        if result["relevance"] >= MIN_RELEVANCE:
+            result_count += 1
+
+    records.append(
+        {
+            "creation_date": utils.now_iso(),
+            "query": normalize(query),
+            "latency": latency,
+            "result_count": result_count,
+            "redirected": redirected,
+            "partial": partial,
+        }
+    )
+
+
+def flush_search_records():
+    batch = []
+    while records:
+        batch.append(SearchRecord(**records.popleft()))
+    if not batch:
+        return
+
+    with app.app.app_context():
+        app.db.session.add_all(batch)
+        app.db.session.commit()
+
+
+app.scheduler.add_job(flush_search_records, "interval", seconds=RECORD_INTERVAL)
+
+
+class FullTextIndex:  # SQLite FTS5 table mirroring the fields of an engine
+    def __init__(self, engine) -> None:
+        self.engine = engine
+        self.name = "search_" + engine.table.__tablename__
+        self.positions = []  # Field positions of the columns, dates are left out
+        for position, field in enumerate(engine.fields):
+            if field["method"] != time_iso:
+                self.positions.append(position)
+        self.columns = [engine.fields[position]["value"] for position in self.positions]
+
+    def create(self):
+        app.db.session.execute(
+            sqlalchemy.text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, prefix='2 3', tokenize='unicode61 remove_diacritics 2')"
+                % (self.name, ", ".join(self.columns))
+            )
+        )
+
+    def rebuild(self):  # Dropped first, in case the fields have changed
+        app.db.session.execute(sqlalchemy.text("DROP TABLE IF EXISTS %s" % self.name))
+        self.create()
+        connection = app.db.session.connection()
+        rows = [row for row, _ in self.engine.getIndexRows()]
+        self.update(connection, rows, [])
+        app.db.session.commit()
+
+    def getValues(self, row):
+        values = {"rowid": row.id}
+        for position in self.positions:
+            field = self.engine.fields[position]
+            values[field["value"]] = self.engine.getValue(row, field)
+        return values
+
+    def update(self, connection, changed_rows, deleted_rows):
+        changed_values = [self.getValues(row) for row in changed_rows]
+        removed_ids = [{"rowid": row.id} for row in changed_rows + deleted_rows]
+
+        if removed_ids:
+            connection.execute(
+                sqlalchemy.text("DELETE FROM %s WHERE rowid = :rowid" % self.name),
+                removed_ids,
+            )
+        if changed_values:
+            connection.execute(
+                sqlalchemy.text(
+                    "INSERT INTO %s (rowid, %s) VALUES (:rowid, %s)"
+                    % (
+                        self.name,
+                        ", ".join(self.columns),
+                        ", ".join(":" + column for column in self.columns),
+                    )
+                ),
+                changed_values,
+            )
+
+    # Like SearchIndex.getWeights, with whether each field matches each token. Rows
+    # come best first, so the best are scored if the budget runs out.
+    def getWeights(self, tokens, budget=None):
+        if not tokens:
+            return {}
+
+        parameters = {"match": " OR ".join('"%s"*' % token for token in tokens)}
+        field_matches = []
+        for token_position, token in enumerate(tokens):
+            for column_position, column in enumerate(self.columns):
+                name = "match_%d_%d" % (token_position, column_position)
+                parameters[name] = '{%s} : "%s"*' % (column, token)
+                field_matches.append(
+                    "rowid IN (SELECT rowid FROM %s WHERE %s MATCH :%s)"
+                    % (self.name, self.name, name)
+                )
+        multipliers = ", ".join(
+            str(self.engine.fields[position]["multiplier"])
+            for position in self.positions
+        )
+
+        rows = app.db.session.execute(
+            sqlalchemy.text(
+                "SELECT rowid, %s FROM %s WHERE %s MATCH :match ORDER BY bm25(%s, %s)"
+                % (
+                    ", ".join(field_matches),
+                    self.name,
+                    self.name,
+                    self.name,
+                    multipliers,
+                )
+            ),
+            parameters,
+        )
+
+        weights = {}
+        for row in rows:
+            if budget and not budget.spend(len(field_matches)):
+                break
+            matches = iter(row[1:])
+            for token_position in range(len(tokens)):
+                for position in self.positions:
+                    if next(matches):
+                        weights[(row[0], position, token_position)] = 1
+        return weights
 
 
-# TODO: Add visibility/permission field
 class SearchEngine:
     engines = []
 
-    def __init__(self, table, fields: list, usage: dict) -> None:
+    # Visibility gives the filter of the rows a user can see, or None for all of
+    # them. Fields may also have a "visible" function, for whether a user can
+    # search them.
+    def __init__(
+        self, table, fields: list, usage: dict, full_text=False, visibility=None
+    ) -> None:
         self.table, self.fields, self.usage = table, fields, usage
+        self.visibility = visibility
+        self.index = SearchIndex(self)
+        self.suggestions = SuggestionIndex(self)
+        self.dates = DateIndex(self)
+        self.spellings = SpellingIndex(self)
+        self.stale = set()  # Ids of rows which changed since they were indexed
+        self.is_indexed = False
+        self.index_lock = threading.RLock()
+        self.full_text = full_text
+        self.full_text_index = full_text and FullTextIndex(self) or None
         SearchEngine.engines.append(self)
 
-    def search(self, query):
-        results = []
-        all_rows = (
-            app.db.session.execute(app.db.select(self.table)).scalars().fetchall()
-        )
-        for row in all_rows:
-            relevance = 0
+    def usesFullText(self):
+        return self.full_text and BACKEND == "fts5"
 
-            for field in self.fields:
-                value = field["value"]
-                if not callable(value):
-                    value = getattr(row, value)
-                if callable(value):
-                    value = value()
+    def getValue(self, row, field):
+        value = field["value"]
+        if not callable(value):
+            value = getattr(row, value)
+        if callable(value):
+            value = value()
+        return value
+
+    def getAccess(self, user):  # The filter of visible rows, and the hidden fields
+        visibility = self.visibility(user) if self.visibility else None
+        hidden_positions = []
+        for position, field in enumerate(self.fields):
+            if "visible" in field and not field["visible"](user):
+                hidden_positions.append(position)
+        return visibility, tuple(hidden_positions)
+
+    # Notices changes which aren't made through the database, before searching
+    def refresh(self):
+        pass
+
+    def markStale(self, ids):  # Rows to reindex, and rankings to forget
+        with self.index_lock:
+            self.stale.update(ids)
+        cache.forget(lambda key: key[0] == self.table)
+
+    def getIndexes(self):  # The indexes which the backend searches with
+        indexes = [self.suggestions, self.dates, self.spellings]
+        if BACKEND != "scan" and not self.usesFullText():
+            indexes.append(self.index)
+        return indexes
+
+    # Builds the indexes, or reindexes the stale rows, reading the rows once for
+    # all of the indexes
+    def refreshIndexes(self):
+        with self.index_lock:
+            if not self.is_indexed:
+                self.stale = set()
+                rows = self.getIndexRows()
+                for index in self.getIndexes():
+                    index.build(rows)
+                self.is_indexed = True
+            elif self.stale:
+                stale, self.stale = self.stale, set()
+                rows = self.getIndexRows(stale)
+                for index in self.getIndexes():
+                    index.update(stale, rows)
+
+    # (row, whether anyone can see it) of every row, or of the rows with the ids.
+    # Only the columns of the fields are loaded when they are all columns.
+    def getIndexRows(self, ids=None):
+        is_public = sqlalchemy.literal(True)
+        if self.visibility:
+            is_public = self.visibility(None)
+            if is_public is None:
+                is_public = sqlalchemy.literal(True)
+
+        select = app.db.select(self.table, is_public)
+        columns = self.getColumnsOfFields()
+        if columns:
+            select = select.options(orm.load_only(*columns))
+        if ids is None:
+            return app.db.session.execute(select).all()
+
+        ids = list(ids)
+        rows = []
+        for start in range(0, len(ids), MAX_LOAD_CHUNK):
+            rows += app.db.session.execute(
+                select.where(self.table.id.in_(ids[start : start + MAX_LOAD_CHUNK]))
+            ).all()
+        return rows
+
+    def getRows(self, ids, visibility=None):
+        return self.getColumns(ids, visibility, self.table)
+
+    def getColumns(self, ids, visibility=None, *columns):  # Loaded in chunks by id
+        ids = list(ids)
+        values = []
+        for start in range(0, len(ids), MAX_LOAD_CHUNK):
+            select = app.db.select(*columns).where(
+                self.table.id.in_(ids[start : start + MAX_LOAD_CHUNK])
+            )
+            if visibility is not None:
+                select = select.where(visibility)
+            values += app.db.session.execute(select).scalars().all()
+        return values
+
+    def getColumnsOfFields(self):  # None if a field isn't read straight from a column
+        columns = []
+        for field in self.fields:
+            column = None
+            if isinstance(field["value"], str):
+                column = getattr(self.table, field["value"], None)
+            if not isinstance(getattr(column, "property", None), orm.ColumnProperty):
+                return None
+            columns.append(column)
+        return columns
+
+    # (relevance, row id) of every visible row, scored with the field methods. Rows
+    # are streamed in chunks, with only the columns of the fields when possible.
+    def scan(self, query, access, budget=None):
+        visibility, hidden_positions = access
+        columns = self.getColumnsOfFields()
+        if columns:
+            select = app.db.select(self.table.id, *columns)
+        else:
+            select = app.db.select(self.table)
+        if visibility is not None:
+            select = select.where(visibility)
+        select = select.execution_options(yield_per=MAX_SCAN_CHUNK)
 
+        for row in app.db.session.execute(select):
+            if budget and not budget.spend(len(self.fields)):
+                break
+            if columns:
+                id, values = row[0], row[1:]
+            else:
+                id, values = row[0].id, [self.getValue(row[0], f) for f in self.fields]
+            relevance = 0
+
+            for position, field in enumerate(self.fields):
+                if position in hidden_positions:
+                    continue
                 relevance += (
-                    field["method"](value or "", query or "") * field["multiplier"]
+                    field["method"](values[position] or "", query or "")
+                    * field["multiplier"]
                 )
 
-            relevance /= len(self.fields) or 1
+            yield relevance / (len(self.fields) or 1), id
+
+    # Each part of a query adds the multipliers of the fields that match it
+    def getRelevances(self, weights, part_count):
+        relevances = {}
+        for (row_id, position, _), weight in weights.items():
+            relevances[row_id] = (
+                relevances.get(row_id, 0) + weight * self.fields[position]["multiplier"]
+            )
+
+        divisor = part_count * (len(self.fields) or 1)
+        for row_id in relevances:
+            relevances[row_id] /= divisor
+        return relevances
+
+    # (relevance, row id) pairs of the most relevant rows, best first. Once the
+    # budget runs out, only the rows scored so far are ranked.
+    def rank(self, query, count=None, access=(None, ()), budget=None):
+        visibility, hidden_positions = access
+        if visibility is not None:
+            visibility_key = str(
+                visibility.compile(compile_kwargs={"literal_binds": True})
+            )
+        else:
+            visibility_key = None
+        key = (self.table, normalize(query), count, visibility_key, hidden_positions)
+        ranked = cache.get(key)
+        if ranked != None:
+            return ranked
+
+        generation = cache.generation
+        if BACKEND == "scan":  # Rows which don't match at all aren't ranked
+            scored = self.scan(query, access, budget)
+            ranked = top(count, (pair for pair in scored if pair[0] > 0))
+        else:
+            text, ranges, years = parse_dates(query)
+            tokens = tokenize(text)
+            self.refreshIndexes()
+            if self.usesFullText():
+                weights = self.full_text_index.getWeights(tokens, budget)
+            else:
+                weights = self.index.getWeights(tokens, budget)
+            part_count = len(tokens)
+
+            # Years left in the text share the part of their token, so that numbers
+            # which aren't years score like any other word
+            parts = []
+            for year in years:
+                if year:
+                    parts.append(tokens.index(year))
+                else:
+                    parts.append(part_count)
+                    part_count += 1
+
+            for key, weight in self.dates.getWeights(ranges, parts).items():
+                weights[key] = max(weight, weights.get(key, 0))
+
+            # Hidden fields and rows are dropped before any relevance is computed
+            weights = {
+                key: weight
+                for key, weight in weights.items()
+                if not key[1] in hidden_positions
+            }
+            if visibility is not None:
+                row_ids = set(key[0] for key in weights)
+                visible_ids = set(self.getColumns(row_ids, visibility, self.table.id))
+                weights = {
+                    key: weight
+                    for key, weight in weights.items()
+                    if key[0] in visible_ids
+                }
+
+            relevances = self.getRelevances(weights, part_count)
+            ranked = top(
+                count, ((relevance, id) for id, relevance in relevances.items())
+            )
+
+        if not (budget and budget.exceeded):  # Partial rankings aren't kept
+            cache.set(key, ranked, generation)
+        return ranked
+
+    def getResults(self, ranked):  # Loads the rows of (relevance, row id) pairs
+        rows = {}
+        for row in self.getRows(id for _, id in ranked):
+            rows[row.id] = row
+
+        results = []
+        for relevance, id in ranked:
+            if not id in rows:
+                continue
 
             newResult = {
-                "item": row,
+                "item": rows[id],
                 "relevance": relevance,
                 "usage": self.usage,
             }
@@ -88,21 +954,278 @@ class SearchEngine:
             results.append(newResult)
         return results
 
-    def searchAll(query):
-        unordered_results = []
+    # Uses its own database session
+    def rankInContext(self, query, count, access, budget):
+        with app.app.app_context():
+            return self.rank(query, count, access, budget)
+
+    # (engine position, ranking) as engines finish
+    def rankAll(query, count=None, user=None, budget=None):
+        futures = {}
+        for position, engine in enumerate(SearchEngine.engines):
+            engine.refresh()
+            # Permissions are checked here, as workers can't use the request's session
+            access = engine.getAccess(user)
+            future = pool.submit(engine.rankInContext, query, count, access, budget)
+            futures[future] = position
+
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+
+    # Rankings are merged into a heap of the best rows, ordered by relevance and
+    # then by engine and row id. With a key to start after, only later rows count.
+    def getBest(rankings, count=None, after=None):
+        best = []  # (relevance, -engine position, -row id, engine position, row id)
+        for position, ranking in rankings:
+            for relevance, id in ranking:
+                entry = (relevance, -position, -id, position, id)
+                if after and entry[:3] >= after:
+                    continue
+                if count == None or len(best) < count:
+                    heapq.heappush(best, entry)
+                elif entry > best[0]:
+                    heapq.heapreplace(best, entry)
+                elif relevance < best[0][0]:
+                    break  # The rest of this ranking is worse
+        best.sort(reverse=True)
+        return best
+
+    def getBestResults(best):
+        # Only the rows which made the cut are loaded, with one query per engine
+        engine_results = {}
+        for position, engine in enumerate(SearchEngine.engines):
+            ranked = [(entry[0], entry[4]) for entry in best if entry[3] == position]
+            for result in engine.getResults(ranked):
+                engine_results[(position, result["item"].id)] = result
+
+        results = []
+        for entry in best:
+            if (entry[3], entry[4]) in engine_results:
+                results.append(engine_results[(entry[3], entry[4])])
+        return results
+
+    # Whether the budget ran out is left on it, for callers which pass their own
+    def searchAll(query, count=None, user=None, budget=None):
+        budget = budget or SearchBudget()
+        rankings = SearchEngine.rankAll(query, count, user, budget)
+        best = SearchEngine.getBest(rankings, count)
+        budget_stats.record(query, budget)
+        return SearchEngine.getBestResults(best)
+
+    # Pages rank every row, so that the rankings are cached for the next pages. The
+    # key to start the next page after is None on the last page.
+    def searchPage(query, count, after=None, user=None, budget=None):
+        budget = budget or SearchBudget()
+        rankings = SearchEngine.rankAll(query, None, user, budget)
+        best = SearchEngine.getBest(rankings, count + 1, after)
+        budget_stats.record(query, budget)
+        next_key = len(best) > count and best[count - 1][:3] or None
+        return SearchEngine.getBestResults(best[:count]), next_key
+
+
+class PageTextParser(html.parser.HTMLParser):  # The title and visible text of a page
+    def __init__(self) -> None:
+        super().__init__()
+        self.title, self.parts = "", []
+        self.tag = None  # The last tag opened or closed
+        self.hidden_depth = 0  # Open tags whose text isn't shown
+
+    def handle_starttag(self, tag, attrs):
+        self.tag = tag
+        if tag in ("script", "style"):
+            self.hidden_depth += 1
+
+    def handle_endtag(self, tag):
+        self.tag = None
+        if tag in ("script", "style"):
+            self.hidden_depth -= 1
+
+    def handle_data(self, data):
+        if self.tag == "title":
+            self.title += data
+        elif not self.hidden_depth:
+            self.parts.append(data)
+
+    def getText(self):
+        return " ".join(" ".join(self.parts).split())
+
+
+class StaticPage:  # A template under the static folder, searched like a row
+    def __init__(self, id, path, url) -> None:
+        self.id, self.path, self.url = id, path, url
+        self.modified = None  # mtime of the file when it was read
+        self.title, self.text = "", ""
+
+    def load(self, modified):
+        with open(self.path, encoding="utf8") as file:
+            template = file.read()
+
+        # Jinja expressions are left out, as they only add the shared layout
+        parser = PageTextParser()
+        parser.feed(re.sub("{{.*?}}|{%.*?%}|{#.*?#}", " ", template, flags=re.DOTALL))
+        self.title, self.text = parser.title.strip(), parser.getText()
+        self.modified = modified
+
+
+class StaticPageEngine(SearchEngine):  # Searches the HTML templates of a folder
+    def __init__(self, folder, fields: list, usage: dict, skipped=()) -> None:
+        super().__init__(StaticPage, fields, usage)
+        self.folder, self.skipped = folder, skipped
+        self.pages = {}  # Path relative to the folder -> StaticPage
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def getUrl(self, path):  # "about-us/index.html" is served at "/about-us/"
+        path = path.replace(os.sep, "/")[: -len(".html")]
+        if path == "index" or path.endswith("/index"):
+            path = path[: -len("index")]
+        return "/" + (path and path.rstrip("/") + "/")
+
+    def refresh(self):  # Rereads the pages whose files were modified
+        changed = set()
+        with self.lock:
+            paths = set()
+            for directory, _, files in os.walk(self.folder):
+                for file in files:
+                    full_path = os.path.join(directory, file)
+                    path = os.path.relpath(full_path, self.folder)
+                    if not path.endswith(".html") or path in self.skipped:
+                        continue
+                    paths.add(path)
+
+                    page = self.pages.get(path)
+                    if not page:
+                        page = StaticPage(self.next_id, full_path, self.getUrl(path))
+                        self.pages[path] = page
+                        self.next_id += 1
+                    modified = os.path.getmtime(full_path)
+                    if modified != page.modified:
+                        page.load(modified)
+                        changed.add(page.id)
+
+            for path in set(self.pages) - paths:
+                changed.add(self.pages.pop(path).id)
+
+        if changed:
+            self.markStale(changed)
+
+    def getAllRows(self):
+        with self.lock:
+            return list(self.pages.values())
+
+    def getRows(self, ids, visibility=None):
+        ids = set(ids)
+        return [page for page in self.getAllRows() if page.id in ids]
+
+    def getIndexRows(self, ids=None):  # Every page can be seen by anyone
+        pages = self.getAllRows() if ids is None else self.getRows(ids)
+        return [(page, True) for page in pages]
+
+    def scan(self, query, access, budget=None):
+        for page in self.getAllRows():
+            if budget and not budget.spend(len(self.fields)):
+                break
+            relevance = 0
+
+            for field in self.fields:
+                value = self.getValue(page, field)
+                relevance += (
+                    field["method"](value or "", query or "") * field["multiplier"]
+                )
+
+            yield relevance / (len(self.fields) or 1), page.id
+
+
+# Names starting with a prefix, without scoring any rows
+def suggest(prefix, count, user=None):
+    prefix = " ".join(tokenize(prefix))
+    if not prefix:
+        return []
+
+    suggestions = []
+    for engine in SearchEngine.engines:
+        engine.refresh()
+        engine.refreshIndexes()
+        matches = engine.suggestions.complete(prefix)
+
+        visibility, _ = engine.getAccess(user)
+        if visibility is not None:
+            visible_ids = set(engine.getColumns(matches, visibility, engine.table.id))
+            matches = {id: matches[id] for id in matches if id in visible_ids}
+
+        for is_later_word, name, url in matches.values():
+            suggestions.append(
+                (is_later_word, len(name), name, engine.usage["type"], url)
+            )
+
+    suggestions.sort()
+    return [
+        {"type": type, "name": name, "url": url}
+        for _, _, name, type, url in suggestions[:count]
+    ]
+
+
+def suggest_spelling(query):  # The query with unknown words corrected, or None
+    for engine in SearchEngine.engines:
+        engine.refreshIndexes()
+
+    text = normalize(query)
+    is_corrected = False
+    for token in set(tokenize(text)):
+        if len(token) < 3 or token.isdigit():
+            continue
+        if any(engine.spellings.isKnown(token) for engine in SearchEngine.engines):
+            continue
+
+        max_distance = len(token) <= 4 and 1 or 2
+        matches = []
         for engine in SearchEngine.engines:
-            unordered_results += engine.search(query)
+            matches += engine.spellings.find(token, max_distance)
+        if not matches:
+            continue
+
+        _, _, correction = min(matches)
+        text = re.sub("\\b%s\\b" % token, correction, text)
+        is_corrected = True
+
+    return is_corrected and text or None
 
-        ordered_results = []
-        for result in unordered_results:
-            for position, otherResult in enumerate(ordered_results):
-                if result["relevance"] > otherResult["relevance"]:
-                    ordered_results.insert(position, result)
-                    break
-            if not result in ordered_results:
-                ordered_results.append(result)
 
-        return ordered_results
+@app.on_create_all
+def build_indexes():
+    for engine in SearchEngine.engines:
+        engine.refresh()
+        if engine.usesFullText():
+            engine.full_text_index.rebuild()
+        engine.refreshIndexes()
+
+
+@app.on_commit
+def mark_stale_rows(changes):
+    for engine in SearchEngine.engines:
+        if engine.table in changes:
+            engine.markStale(changes[engine.table])
+
+
+# Full text tables are written in the same transaction as the rows they mirror
+@sqlalchemy.event.listens_for(orm.Session, "after_flush")
+def sync_full_text(session, flush_context):
+    for engine in SearchEngine.engines:
+        if not engine.usesFullText():
+            continue
+
+        changed_rows, deleted_rows = [], []
+        for instance in list(session.new) + list(session.dirty):
+            if isinstance(instance, engine.table):
+                changed_rows.append(instance)
+        for instance in session.deleted:
+            if isinstance(instance, engine.table):
+                deleted_rows.append(instance)
+
+        if changed_rows or deleted_rows:
+            engine.full_text_index.update(
+                session.connection(), changed_rows, deleted_rows
+            )
 
 
 # API
@@ -119,13 +1242,120 @@ def api_search():
     )
 
 
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode("utf8")).decode("utf8")
+
+
+def get_number(name, default):  # A number argument of the request, if it is given
+    try:
+        return int(flask.request.args.get(name) or "0") or default
+    except ValueError:
+        raise errors.exceptions.BadRequest
+
+
+def decode_cursor(cursor):
+    try:
+        relevance, position, id = json.loads(base64.urlsafe_b64decode(cursor))
+        return (float(relevance), int(position), int(id))
+    except (ValueError, TypeError):
+        raise errors.exceptions.BadRequest
+
+
+@app.app.route("/api/search/", methods=["GET"])
+def api_search_page():
+    query = flask.request.args.get("query")
+    cursor = flask.request.args.get("cursor")
+    count = get_number("count", 10)
+    count = max(1, min(50, count))
+
+    if not query:
+        raise errors.exceptions.BadRequest
+
+    start = time.perf_counter()
+    budget = SearchBudget()
+    results, next_key = SearchEngine.searchPage(
+        query[:MAX_REQUEST_LENGTH],
+        count,
+        cursor and decode_cursor(cursor),
+        users.User.getFromRequest(),
+        budget,
+    )
+    if not cursor:  # Later pages are the same search
+        record_search(
+            query,
+            time.perf_counter() - start,
+            results,
+            partial=bool(budget.exceeded),
+        )
+
+    return json.dumps(
+        {
+            "results": [
+                {
+                    "type": result["usage"]["type"],
+                    "name": result["usage"]["name"](result["item"]),
+                    "url": result["usage"]["url"](result["item"]),
+                    "relevance": result["relevance"],
+                }
+                for result in results
+            ],
+            "cursor": next_key and encode_cursor(next_key) or None,
+            "partial": bool(budget.exceeded),
+        }
+    )
+
+
+@app.app.route("/api/search/suggestions/")
+def api_search_suggestions():
+    prefix = flask.request.args.get("prefix") or ""
+    count = get_number("count", 5)
+
+    return json.dumps(
+        suggest(
+            prefix[:MAX_REQUEST_LENGTH],
+            max(1, min(MAX_SUGGESTIONS, count)),
+            users.User.getFromRequest(),
+        )
+    )
+
+
+@app.app.route("/api/search/stats/")
+def api_search_stats():
+    user = users.User.getFromRequestOrAbort()
+    if not user.is_admin:
+        raise errors.NeedPermission
+
+    return json.dumps({"cache": cache.getStats(), "budget": budget_stats.getStats()})
+
+
+@app.app.route("/search/stats/")
+def pages_search_stats():
+    user = users.User.getFromRequestOrAbort()
+    if not user.is_admin:
+        raise errors.NeedPermission
+
+    days = get_number("days", 7)
+    since = (utils.now() - timedelta(days=days)).isoformat()
+
+    return flask.render_template(
+        "/search_stats.html",
+        days=days,
+        median=SearchRecord.getPercentile(since, 0.5),
+        percentile_95=SearchRecord.getPercentile(since, 0.95),
+        slowest=SearchRecord.getSlowest(since, 20),
+        unanswered=SearchRecord.getUnanswered(since, 20),
+        cache=cache.getStats(),
+        budget=budget_stats.getStats(),
+    )
+
+
 # Pages
 @app.app.route("/search/")
 def pages_search():
     query = flask.request.args.get("query")
     stay = flask.request.args.get("stay")
-    count = int(flask.request.args.get("count") or "0") or 5
-    count = min(50, count)
+    count = get_number("count", 5)
+    count = max(1, min(50, count))
 
     if query and len(query) > MAX_REQUEST_LENGTH:
         return flask.redirect(
@@ -141,7 +1371,12 @@ def pages_search():
         if len(query) > MAX_REQUEST_LENGTH:
             raise errors.exceptions.BadRequest
 
-        results = SearchEngine.searchAll(query)
+        # Enough results to display, and to judge whether to auto redirect
+        start = time.perf_counter()
+        budget = SearchBudget()
+        results = SearchEngine.searchAll(
+            query, max(count, 3), users.User.getFromRequest(), budget
+        )
 
         if stay == "off" and len(results):  # Auto redirect if very confident result
             sum_secondary_results = 0
@@ -150,12 +1385,41 @@ def pages_search():
                     continue
                 result = results[result_index]
                 sum_secondary_results += result["relevance"]
-            if results[0]["relevance"] > max(sum_secondary_results * 1.25, 0.1):
+            if results[0]["relevance"] > max(
+                sum_secondary_results * 1.25, MIN_RELEVANCE
+            ):
+                record_search(
+                    query,
+                    time.perf_counter() - start,
+                    results[:count],
+                    redirected=True,
+                    partial=bool(budget.exceeded),
+                )
                 return flask.redirect(results[0]["usage"]["url"](results[0]["item"]))
 
+        # Only look for a better spelling when nothing relevant was found
+        suggestion = None
+        if not results or results[0]["relevance"] < MIN_RELEVANCE:
+            suggestion = suggest_spelling(query)
+
+        record_search(
+            query,
+            time.perf_counter() - start,
+            results[:count],
+            partial=bool(budget.exceeded),
+        )
+
         # TODO: Allow results to display HTML (summary, image)
         return flask.render_template(
-            "/search.html", query=query, results=results[:count], stay=stay
+            "/search.html",
+            query=query,
+            results=results[:count],
+            min_relevance=MIN_RELEVANCE,
+            stay=stay,
+            suggestion=suggestion,
+            partial=bool(budget.exceeded),
+            suggestion_url=suggestion
+            and flask.url_for("pages_search", query=suggestion, stay=stay, count=count),
         )
     else:
         return flask.render_template("/search.html", stay=stay)
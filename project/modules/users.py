@@ -4,6 +4,7 @@ import project.core.errors as errors
 import project.core.config as config
 import project.modules.roles as roles
 import project.modules.search as search
+import sqlalchemy
 import sqlalchemy.orm as orm
 import flask
 import uuid
@@ -17,6 +18,10 @@ def hash(code):
     return bcrypt.hashpw(code.encode("utf8"), bcrypt.gensalt()).decode("utf8")
 
 
+permission_cache = utils.Cache()  # Bitmasks of the permissions of users, by user id
+team_roster = utils.Cache()  # The teams shown on /teams/
+
+
 # Classes
 class Session(app.db.Model):
     id: orm.Mapped[int] = orm.mapped_column(primary_key=True)
@@ -39,13 +44,32 @@ class Session(app.db.Model):
             )
         ).scalar_one_or_none()
 
+    # Looked up once per request, until it is forgotten on logging in or out
+    def getFromRequest() -> "Session":
+        if not "session" in flask.g:
+            raw = flask.request.cookies.get("session")
+            flask.g.session = raw and Session.getFromRaw(raw) or None
+        return flask.g.session
+
+    def forgetRequest():
+        flask.g.pop("session", None)
+        flask.g.pop("user", None)
+
+
+class UserRole(app.db.Model):  # Which roles each user has
+    __table_args__ = (sqlalchemy.UniqueConstraint("user_id", "role_id"),)
+
+    id: orm.Mapped[int] = orm.mapped_column(primary_key=True)
+    user_id: orm.Mapped[int] = orm.mapped_column(index=True)
+    role_id: orm.Mapped[int] = orm.mapped_column(index=True)
+
 
 class User(app.db.Model):
     id: orm.Mapped[int] = orm.mapped_column(primary_key=True)
     creation_date: orm.Mapped[str] = orm.mapped_column()
     username: orm.Mapped[str] = orm.mapped_column(unique=True)
     password: orm.Mapped[str] = orm.mapped_column(unique=True)
-    roles: orm.Mapped[str] = orm.mapped_column(default="[]")
+    roles: orm.Mapped[str] = orm.mapped_column(default="[]")  # Moved to UserRole
     is_admin: orm.Mapped[bool] = orm.mapped_column(default=False)
     display_name: orm.Mapped[str] = orm.mapped_column(nullable=True)
     email: orm.Mapped[str] = orm.mapped_column(nullable=True)
@@ -57,19 +81,26 @@ class User(app.db.Model):
             app.db.select(User).where(User.id == id)
         ).scalar_one_or_none()
 
-    def getFromSession(session: Session) -> "User":
-        return User.getFromId(session.user_id)
+    def getFromIds(ids) -> dict:  # User id -> User, from one query
+        ids = set(ids)
+        if not ids:
+            return {}
 
-    def getFromRequest() -> "User":
-        raw = flask.request.cookies.get("session")
-        if not raw:
-            return
+        return {
+            user.id: user
+            for user in app.db.session.execute(
+                app.db.select(User).where(User.id.in_(ids))
+            ).scalars()
+        }
 
-        session = Session.getFromRaw(raw)
-        if not session:
-            return
+    def getFromSession(session: Session) -> "User":
+        return User.getFromId(session.user_id)
 
-        return User.getFromSession(session)
+    def getFromRequest() -> "User":  # Cached for the request like its session
+        if not "user" in flask.g:
+            session = Session.getFromRequest()
+            flask.g.user = session and User.getFromSession(session) or None
+        return flask.g.user
 
     def getFromRequestOrAbort() -> "User":
         user = User.getFromRequest()
@@ -108,79 +139,99 @@ class User(app.db.Model):
         return roles_text.removesuffix(", ")
 
     def getRoles(self):
-        parsed_roles = []
-        for role_id in json.loads(self.roles or "[]"):
-            role = roles.Role.getFromId(role_id)
-            if not role:
-                continue
-            parsed_roles.append(role)
-
-        self.setRoles(parsed_roles)
-
-        return parsed_roles
+        return (
+            app.db.session.execute(
+                app.db.select(roles.Role)
+                .join(UserRole, UserRole.role_id == roles.Role.id)
+                .where(UserRole.user_id == self.id)
+                .order_by(roles.Role.id)
+            )
+            .scalars()
+            .all()
+        )
 
     def setRoles(self, new_roles):
-        raw_roles = []
+        for role in self.getRoles():
+            if not role in new_roles:
+                self.removeRole(role)
         for role in new_roles:
-            if not role or not role.id or not roles.Role.getFromId(role.id):
-                continue
-            raw_roles.append(role.id)
+            if role and role.id:
+                self.addRole(role)
 
-        raw_roles.sort()
-        self.roles = json.dumps(raw_roles)
+    def getUserRole(self, role):
+        return app.db.session.execute(
+            app.db.select(UserRole).where(
+                UserRole.user_id == self.id, UserRole.role_id == role.id
+            )
+        ).scalar_one_or_none()
 
     def addRole(self, role):
-        roles = self.getRoles()
-        if role in roles:
-            return
-        roles.append(role)
-        self.setRoles(roles)
+        if not self.getUserRole(role):
+            app.db.session.add(UserRole(user_id=self.id, role_id=role.id))
 
     def removeRole(self, role):
-        roles = self.getRoles()
-        while role in roles:
-            roles.remove(role)
-        self.setRoles(roles)
+        user_role = self.getUserRole(role)
+        if user_role:
+            app.db.session.delete(user_role)
 
     def hasRole(self, role):
-        return role in self.getRoles()
+        return self.getUserRole(role) != None
 
     # Permissions
+    def getPermissionMask(self) -> int:  # Permissions of all of the user's roles
+        def build():
+            mask = 0
+            for role in self.getRoles():
+                mask |= role.getPermissionMask()
+            return mask
+
+        return permission_cache.getOrBuild(self.id, build)
+
     def hasPermission(self, permission) -> bool:
-        for role in self.getRoles():
-            if role.hasPermission(permission):
-                return True
-        return False
+        return bool(self.getPermissionMask() & roles.get_permission_mask(permission))
 
     def hasPermissionOrAbort(self, permission):
         if not self.hasPermission(permission):
             raise errors.NeedPermission
 
     def hasAPermission(self, *permissions):
-        for permission in permissions:
-            if self.hasPermission(permission):
-                return True
-        return False
+        return bool(self.getPermissionMask() & roles.get_permission_mask(*permissions))
 
     def hasAPermissionOrAbort(self, *permissions):
         if not self.hasAPermission(*permissions):
             raise errors.NeedPermission
 
-    def getHighestRole(self):
-        highest_role = None
-        for role in self.getRoles():
-            if not highest_role:
-                highest_role = role
-                continue
-            if role.overseesRole(highest_role):
-                highest_role = role
-        return highest_role
+    def getHighestRole(self):  # The role with the fewest ancestors
+        return app.db.session.execute(
+            app.db.select(roles.Role)
+            .join(UserRole, UserRole.role_id == roles.Role.id)
+            .join(roles.RoleAncestor, roles.RoleAncestor.descendant_id == roles.Role.id)
+            .where(UserRole.user_id == self.id)
+            .group_by(roles.Role.id)
+            .order_by(sqlalchemy.func.count(roles.RoleAncestor.id), roles.Role.id)
+            .limit(1)
+        ).scalar_one_or_none()
 
     def overseesRole(self, other_role) -> bool:
-        for role in self.getRoles():
-            if role.overseesRole(other_role):
-                return True
-        return False
+        if not other_role or not other_role.id:
+            return False
+
+        return (
+            app.db.session.execute(
+                app.db.select(roles.RoleAncestor.id)
+                .join(UserRole, UserRole.role_id == roles.RoleAncestor.ancestor_id)
+                .where(
+                    UserRole.user_id == self.id,
+                    roles.RoleAncestor.descendant_id == other_role.id,
+                    roles.RoleAncestor.depth > 0,
+                )
+                .limit(1)
+            ).first()
+            != None
+        )
+
+    def canSeeContactInfo(user) -> bool:  # Whether a user can search emails and phones
+        return bool(user and user.hasPermission(roles.Permission.ManageUsers))
 
     def overseesUser(self, user) -> bool:
         highest_role, user_highest_role = self.getHighestRole(), user.getHighestRole()
@@ -191,6 +242,43 @@ class User(app.db.Model):
         return highest_role.overseesRole(user_highest_role)
 
 
+@app.on_commit
+def forget_permissions(changes):
+    if roles.Role in changes or UserRole in changes:  # Any user may have the role
+        permission_cache.forget()
+    elif User in changes:
+        permission_cache.forget(lambda user_id: user_id in changes[User])
+
+
+def build_team_roster():  # Roles which have users and their users, from one query
+    teams = []
+    memberships = app.db.session.execute(
+        app.db.select(roles.Role, User)
+        .join(UserRole, UserRole.role_id == roles.Role.id)
+        .join(User, User.id == UserRole.user_id)
+        .where(roles.Role.id != 1)
+        .order_by(roles.Role.id, User.id)
+    )
+    for role, user in memberships:
+        if not teams or teams[-1]["id"] != role.id:
+            teams.append(
+                {
+                    "id": role.id,
+                    "label": role.label,
+                    "description": role.description,
+                    "users": [],
+                }
+            )
+        teams[-1]["users"].append({"id": user.id, "name": user.getNameText()})
+    return teams
+
+
+@app.on_commit
+def forget_team_roster(changes):
+    if roles.Role in changes or User in changes or UserRole in changes:
+        team_roster.forget()
+
+
 search.SearchEngine(
     User,
     [
@@ -213,11 +301,13 @@ search.SearchEngine(
             "value": "email",
             "method": search.basic_text,
             "multiplier": 1.5,
+            "visible": User.canSeeContactInfo,
         },
         {
             "value": "phone",
             "method": search.basic_text,
             "multiplier": 1.5,
+            "visible": User.canSeeContactInfo,
         },
         {
             "value": "creation_date",
@@ -253,7 +343,6 @@ def create_admin():
             creation_date=utils.now_iso(),
             username=admin_username,
             password=hash(admin_password),
-            roles="[1]",
             is_admin=True,
             display_name=admin_username,
             description="The administrator account for this website.",
@@ -261,6 +350,23 @@ def create_admin():
         app.db.session.add(admin_user)
         app.db.session.commit()
 
+        admin_user.addRole(roles.Role.getRootRole())
+        app.db.session.commit()
+
+
+@app.on_create_all
+def move_roles_to_table():  # Roles used to be a JSON list of ids in User.roles
+    role_ids = set(app.db.session.execute(app.db.select(roles.Role.id)).scalars())
+    moved_users = app.db.session.execute(
+        app.db.select(User).where(User.roles != "[]")
+    ).scalars()
+    for user in moved_users:
+        for role_id in json.loads(user.roles or "[]"):
+            if role_id in role_ids:
+                user.addRole(roles.Role.getFromId(role_id))
+        user.roles = "[]"
+    app.db.session.commit()
+
 
 # API
 @app.app.route("/api/users/<int:id>/")
@@ -309,6 +415,9 @@ def create_user(id=None):
     if flask.request.method == "DELETE":
         if user.id == 1:
             return "You cannot delete the admin account.", 403
+        app.db.session.execute(
+            app.db.delete(UserRole).where(UserRole.user_id == user.id)
+        )
         app.db.session.delete(user)
         app.db.session.commit()
         return flask.redirect("/users/")
@@ -363,6 +472,7 @@ def create_user(id=None):
 
     session = user.createSession()
     app.db.session.commit()
+    Session.forgetRequest()
 
     if flask.request.method == "POST":
         response = flask.make_response(flask.redirect("/manage/", code=303))
@@ -399,6 +509,7 @@ def create_session():
 
     session = user.createSession()
     app.db.session.commit()
+    Session.forgetRequest()
 
     response = flask.make_response(flask.redirect("/manage/"))
     response.set_cookie(  # TODO BUG: Safari doesn't save cookie (max_age?) Also see other set_cookie
@@ -432,6 +543,7 @@ def delete_sessions():
     for session in sessions:
         app.db.session.delete(session)
     app.db.session.commit()
+    Session.forgetRequest()
 
     response = flask.make_response(flask.redirect("/", code=303))
     response.delete_cookie("session", "/")
@@ -441,12 +553,13 @@ def delete_sessions():
 
 @app.app.route("/api/sessions/", methods=["DELETE"])
 def delete_session():
-    session = Session.getFromRaw(flask.request.cookies["session"])
+    session = Session.getFromRequest()
     if not session:
         return flask.make_response("You could not be authenticated.", 401)
 
     app.db.session.delete(session)
     app.db.session.commit()
+    Session.forgetRequest()
 
     response = flask.make_response(flask.redirect("/", code=303))
     response.delete_cookie("session", "/")
@@ -464,8 +577,7 @@ def user_list():
 @app.app.route("/teams/")
 def team_list():
     return flask.render_template(
-        "users/teams.html",
-        roles=app.db.session.execute(app.db.select(roles.Role)).scalars().all(),
+        "users/teams.html", teams=team_roster.getOrBuild("teams", build_team_roster)
     )
 
 
@@ -0,0 +1,85 @@
+# Times how the best search results are picked from every engine's rows, with the
+# heaps of search.top and SearchEngine.getBest against the insertion loop they replaced.
+# Run from the repository root: python3 scripts/benchmark_top_k.py [rows ...]
+from sys import path, argv
+
+path.append(".")
+
+from project.core import config, app, pages, errors, utils
+import project.templates
+from project.modules import users, roles, articles, posts, manage, events
+import project.modules.search as search
+import random
+import time
+
+COUNTS = [5, 50]  # The default page size and the largest one
+
+
+# Scored rows spread over the engines, like a query of all of them
+def make_results(rows):
+    generator = random.Random(rows)
+    engine_count = len(search.SearchEngine.engines)
+    engine_results = [[] for _ in range(engine_count)]
+    for id in range(rows):
+        engine_results[id % engine_count].append((generator.random(), id))
+    return engine_results
+
+
+def old_best(engine_results):  # The merge searchAll used before the heaps
+    unordered_results = []
+    for results in engine_results:
+        for relevance, id in results:
+            unordered_results.append({"item": id, "relevance": relevance})
+
+    ordered_results = []
+    for result in unordered_results:
+        for position, otherResult in enumerate(ordered_results):
+            if result["relevance"] > otherResult["relevance"]:
+                ordered_results.insert(position, result)
+                break
+        if not result in ordered_results:
+            ordered_results.append(result)
+
+    return ordered_results
+
+
+def new_best(engine_results, count):  # Each engine ranks its own rows, then they merge
+    rankings = [
+        (position, search.top(count, results))
+        for position, results in enumerate(engine_results)
+    ]
+    return search.SearchEngine.getBest(rankings, count)
+
+
+def get_time(function, *arguments, repeats=1):  # The fastest of the repeats
+    best_time = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        value = function(*arguments)
+        elapsed = time.perf_counter() - start
+        best_time = min(best_time or elapsed, elapsed)
+    return best_time, value
+
+
+def benchmark(rows):
+    engine_results = make_results(rows)
+    old_time, old_results = get_time(old_best, engine_results)
+    line = "%8d %10.1f" % (rows, old_time * 1000)
+
+    for count in COUNTS:
+        new_time, best = get_time(new_best, engine_results, count, repeats=5)
+        expected = [result["relevance"] for result in old_results[:count]]
+        if [entry[0] for entry in best] != expected:
+            raise Exception("The heaps picked other results for %d rows" % rows)
+        line += " %10.2f %7.0fx" % (new_time * 1000, old_time / new_time)
+    print(line)
+
+
+if __name__ == "__main__":
+    header = "%8s %10s" % ("rows", "old ms")
+    for count in COUNTS:
+        header += " %10s %8s" % ("top %d ms" % count, "faster")
+    print(header)
+
+    for rows in [int(rows) for rows in argv[1:]] or [2000, 5000, 10000]:
+        benchmark(rows)
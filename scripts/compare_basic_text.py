@@ -0,0 +1,231 @@
+# Compares search.basic_text with the SequenceMatcher scorer it replaced, by how
+# similarly both rank a fixed corpus, and checks it against a plain dynamic program.
+# Run from the repository root: python3 scripts/compare_basic_text.py [cases]
+from sys import path, argv
+
+path.append(".")
+
+from project.core import config, app, pages, errors, utils
+import project.templates
+from project.modules import users, roles, articles, posts, manage, events
+import project.modules.search as search
+import random
+import time
+from difflib import SequenceMatcher
+from unidecode import unidecode
+
+SUBJECTS = [
+    "The robotics team",
+    "Our Raspberry Pi club",
+    "The programming workshop",
+    "A soldering class",
+    "The Hartford chapter",
+    "Volunteers from the library",
+    "The competition committee",
+    "Students in the electronics lab",
+]
+ACTIONS = [
+    "built a line following robot",
+    "met to plan the spring fundraiser",
+    "published the meeting schedule",
+    "won second place at the regional competition",
+    "taught Python programming to beginners",
+    "repaired a broken 3D printer",
+    "wired sensors to a Raspberry Pi",
+    "wrote a café guide for new members",
+]
+DETAILS = [
+    "on Saturday morning.",
+    "after school in room 204.",
+    "with help from parents and mentors.",
+    "and shared photos on the website.",
+    "before the state finals in March.",
+    "using donated parts.",
+    "",
+]
+QUERIES = [
+    "robot",
+    "robtics",
+    "competition",
+    "compettion",
+    "hartford",
+    "programing",
+    "raspbery pi",
+    "fundraiser",
+    "meeting schedule",
+    "cafe",
+]
+
+
+def make_corpus(size=60):  # Same documents every run
+    generator = random.Random(2024)
+    corpus = []
+    for _ in range(size):
+        sentences = []
+        for _ in range(generator.randint(1, 3)):
+            sentence = " ".join(
+                [
+                    generator.choice(SUBJECTS),
+                    generator.choice(ACTIONS),
+                    generator.choice(DETAILS),
+                ]
+            )
+            sentences.append(sentence.strip())
+        corpus.append(" ".join(sentences))
+    return corpus
+
+
+def old_basic_text(text, query):  # The scorer before the bit-parallel matcher
+    text = unidecode(text.lower())
+    query = unidecode(query.lower())
+
+    ratio_sum = 0
+    ratio_count = 0
+
+    for position in range(0, len(text)):
+        current_text = text[position : position + len(query)]
+
+        base_value = SequenceMatcher(None, current_text, query).ratio()
+        exponential_value = 5 ** (base_value - 0.5) - 1
+        exponential_value = max(min(exponential_value, 1), 0)
+
+        if exponential_value > 0:
+            ratio_sum += exponential_value
+            ratio_count += 1
+
+    return ratio_sum / (ratio_count or 1)
+
+
+def get_ranks(values):  # Tied values share their average rank
+    order = sorted(range(len(values)), key=lambda index: values[index])
+    ranks = [0] * len(values)
+    start = 0
+    while start < len(order):
+        end = start
+        while end + 1 < len(order) and values[order[end + 1]] == values[order[start]]:
+            end += 1
+        for position in range(start, end + 1):
+            ranks[order[position]] = (start + end) / 2
+        start = end + 1
+    return ranks
+
+
+def spearman(first, second):
+    first, second = get_ranks(first), get_ranks(second)
+    first_mean = sum(first) / len(first)
+    second_mean = sum(second) / len(second)
+    covariance = sum(
+        (a - first_mean) * (b - second_mean) for a, b in zip(first, second)
+    )
+    first_spread = sum((a - first_mean) ** 2 for a in first) ** 0.5
+    second_spread = sum((b - second_mean) ** 2 for b in second) ** 0.5
+    if not first_spread or not second_spread:
+        return float("nan")
+    return covariance / (first_spread * second_spread)
+
+
+def get_top(scores, count=5):  # Documents repeat phrases, so the top often ties
+    return set(sorted(range(len(scores)), key=lambda index: -scores[index])[:count])
+
+
+# Quadratic edit distances of the best match ending at each character, like
+# search.match_distances
+def reference_distances(text, query):
+    column = list(range(len(query) + 1))
+    for character in text:
+        new_column = [0]
+        for position, query_character in enumerate(query, 1):
+            new_column.append(
+                min(
+                    column[position] + 1,
+                    new_column[position - 1] + 1,
+                    column[position - 1] + (character != query_character),
+                )
+            )
+        column = new_column
+        yield column[-1]
+
+
+def reference_basic_text(text, query):
+    text = unidecode(text.lower())
+    query = unidecode(query.lower())
+    if not query:
+        return 0
+
+    ratio_sum = 0
+    ratio_count = 0
+    for distance in reference_distances(text, query):
+        base_value = 1 - distance / len(query)
+        exponential_value = 5 ** (base_value - 0.5) - 1
+        exponential_value = max(min(exponential_value, 1), 0)
+        if exponential_value > 0:
+            ratio_sum += exponential_value
+            ratio_count += 1
+    return ratio_sum / (ratio_count or 1)
+
+
+def reference_edit_distance(text, query):  # Whole text against whole query
+    column = list(range(len(query) + 1))
+    for index, character in enumerate(text, 1):
+        new_column = [index]
+        for position, query_character in enumerate(query, 1):
+            new_column.append(
+                min(
+                    column[position] + 1,
+                    new_column[position - 1] + 1,
+                    column[position - 1] + (character != query_character),
+                )
+            )
+        column = new_column
+    return column[-1]
+
+
+def compare_rankings(corpus):
+    print(
+        "%-18s %8s %6s %10s %10s" % ("query", "spearman", "top 5", "old ms", "new ms")
+    )
+    correlations = []
+    for query in QUERIES:
+        start = time.perf_counter()
+        old_scores = [old_basic_text(text, query) for text in corpus]
+        old_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        new_scores = [search.basic_text(text, query) for text in corpus]
+        new_time = time.perf_counter() - start
+
+        correlation = spearman(old_scores, new_scores)
+        correlations.append(correlation)
+        overlap = len(get_top(old_scores) & get_top(new_scores))
+        print(
+            "%-18s %8.3f %4d/5 %10.1f %10.1f"
+            % (query, correlation, overlap, old_time * 1000, new_time * 1000)
+        )
+    print("mean spearman %.3f" % (sum(correlations) / len(correlations)))
+
+
+def check_reference(cases):
+    generator = random.Random(1999)
+    mismatches = 0
+    for _ in range(cases):
+        text = "".join(
+            generator.choice("abcdé ") for _ in range(generator.randint(0, 40))
+        )
+        query = "".join(
+            generator.choice("abcde") for _ in range(generator.randint(0, 12))
+        )
+        if search.edit_distance(text, query) != reference_edit_distance(text, query):
+            mismatches += 1
+        elif (
+            abs(search.basic_text(text, query) - reference_basic_text(text, query))
+            > 1e-9
+        ):
+            mismatches += 1
+    print("%d random cases, %d mismatches against the reference" % (cases, mismatches))
+    return mismatches
+
+
+if __name__ == "__main__":
+    compare_rankings(make_corpus())
+    if check_reference(len(argv) > 1 and int(argv[1]) or 3000):
+        exit(1)